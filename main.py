@@ -1,23 +1,64 @@
+import io
 import os
 import shutil
+import asyncio
+import contextlib
 import subprocess
+import tempfile
+import threading
+import time
 import uuid
 import logging
 import hashlib
-from typing import Optional
+import functools
+from dataclasses import dataclass
+from typing import Optional, Union
 from pathlib import Path
+from http.client import HTTPConnection
 
 import boto3
-import requests
-from botocore.exceptions import NoCredentialsError
+import httpx
+import urllib3.connection
+from boto3.s3.transfer import TransferConfig
+from botocore.awsrequest import AWSHTTPSConnection
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+from cachetools import TTLCache
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
 from fastapi.responses import FileResponse, JSONResponse
+from PIL import Image, ImageCms
+
+# libvips sizes its thread pool to every core when it initialises on import;
+# hold each render to the same per-process budget as magick
+os.environ.setdefault("VIPS_CONCURRENCY", os.getenv("MAGICK_THREAD_LIMIT") or "1")
+try:
+    import pyvips
+except (ImportError, OSError):  # pyvips installed without the libvips shared library
+    pyvips = None
 
 # --- Configuration & Logging ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("pixload-darkroom")
 
-app = FastAPI(title="Pixload Darkroom", version="1.3 (Surgical)")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Close the shared download client's pooled connections on shutdown
+    await http_client.aclose()
+
+app = FastAPI(title="Pixload Darkroom", version="1.3 (Surgical)", lifespan=lifespan)
+
+def available_cpus() -> int:
+    """Cores this container may use: CPU affinity, capped by a cgroup v2 quota."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            # compose `cpus:` sets a CFS quota, not an affinity mask
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
 
 # --- Environment Variables ---
 AUTH_TOKEN = os.getenv("PIXLOAD_IMAGE_TOKEN", "changeme")
@@ -28,53 +69,410 @@ S3_REGION = os.getenv("S3_REGION", "auto")
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY_ID")
 S3_SECRET_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "https://cdn.pixload.events")
+TMP_ROOT = Path(os.getenv("PIXLOAD_TMP", "/dev/shm"))
+OVERLAY_CACHE_DIR = Path(os.getenv("OVERLAY_CACHE_DIR", "/var/cache/pixload/overlays"))
+OVERLAY_CACHE_MAX = int(os.getenv("OVERLAY_CACHE_MAX", "256"))
+OVERLAY_CACHE_TTL = int(os.getenv("OVERLAY_CACHE_TTL", "86400"))
 MAGICK_THREAD_LIMIT = os.getenv("MAGICK_THREAD_LIMIT", "1")
-
-# Strict MIME Type Mapping
-MIME_TYPES = {
-    "jpg": "image/jpeg",
-    "jpeg": "image/jpeg",
-    "png": "image/png",
-    "webp": "image/webp",
-    "avif": "image/avif",
-    "heic": "image/heic"
+SKIP_REDUNDANT_OPS = os.getenv("SKIP_REDUNDANT_OPS", "1") == "1"
+VIPS_FAST_PATH = os.getenv("VIPS_FAST_PATH", "1") == "1"
+CPU_COUNT = available_cpus()
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", min(CPU_COUNT, 4)))
+# AVIF/HEIC encoding (libheif/libaom) is the one stage that scales with cores:
+# give it this worker's share of the CPU instead of a single thread. Concurrent
+# AVIF encodes in one worker oversubscribe by up to ENGINE_WORKERS x; that trades
+# throughput under an all-AVIF burst for latency of the typical lone encode.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+AVIF_THREAD_LIMIT = os.getenv(
+    "AVIF_THREAD_LIMIT", str(max(1, CPU_COUNT // WEB_CONCURRENCY))
+)
+
+@dataclass(frozen=True, slots=True)
+class FormatSpec:
+    mime: str
+    ext: str
+    enc: tuple[str, ...]  # magick encode args; {q} and {avif_speed} are filled per template
+
+# Strict output format table, resolved once at import
+FORMATS = {
+    "jpg": FormatSpec("image/jpeg", "jpg", ("-quality", "{q}", "-interlace", "Plane")),
+    "jpeg": FormatSpec("image/jpeg", "jpg", ("-quality", "{q}", "-interlace", "Plane")),
+    "png": FormatSpec("image/png", "png", ()),
+    "webp": FormatSpec("image/webp", "webp", ("-quality", "{q}", "-define", "webp:method=6")),
+    # For ImageMagick 7 static binary, heic:speed controls libheif performance
+    "avif": FormatSpec("image/avif", "avif", ("-quality", "{q}", "-define", "heic:speed={avif_speed}")),
+    "heic": FormatSpec("image/heic", "heic", ())
 }
 
+# Output formats the libvips fast path can encode (AVIF/HEIC stay on ImageMagick)
+VIPS_FORMATS = {"jpg", "jpeg", "png", "webp"}
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Hash of the rendered output used in generated S3 keys
+OUTPUT_DIGEST = functools.partial(hashlib.blake2b, digest_size=8)
+
+# Caps concurrent magick processes per worker; extra requests queue instead of forking
+ENGINE_SLOTS = asyncio.Semaphore(ENGINE_WORKERS)
+
+# Multipart settings for larger renders (AVIF/PNG can exceed the 8 MiB default threshold)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=4 * 1024 * 1024,
+    multipart_chunksize=4 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True
+)
+
+# Generated keys recently confirmed in the bucket; skips even the HEAD round-trip.
+# Upload threads share it, and TTLCache itself is not thread-safe.
+KNOWN_KEYS = TTLCache(maxsize=10_000, ttl=300)
+KNOWN_KEYS_LOCK = threading.Lock()
+
+# Shared async HTTP client for source/overlay downloads (keeps connections warm)
+http_client = httpx.AsyncClient(timeout=15, http2=True, follow_redirects=True)
+
 # --- Helpers ---
 
+# boto3 sends request bodies through http.client, which writes them in
+# `blocksize` chunks (8 KiB stdlib default, 16 KiB under urllib3 2) and
+# re-acquires the GIL for every write. Patch the defaults at import so S3
+# PUTs from our upload threads are written in 1 MiB chunks instead.
+# urllib3 2's HTTPSConnection passes its own blocksize default down, so it
+# needs patching too: S3/R2 endpoints are HTTPS.
+HTTP_BLOCKSIZE = 1024 * 1024
+
+HTTPConnection.__init__.__defaults__ = tuple(
+    HTTP_BLOCKSIZE if x == 8192 else x for x in HTTPConnection.__init__.__defaults__
+)
+for conn_cls in (urllib3.connection.HTTPConnection, urllib3.connection.HTTPSConnection):
+    if "blocksize" in (conn_cls.__init__.__kwdefaults__ or {}):
+        conn_cls.__init__.__kwdefaults__ = {
+            **conn_cls.__init__.__kwdefaults__,
+            "blocksize": HTTP_BLOCKSIZE,
+        }
+
+# Check the size botocore's connections actually end up with (no I/O until connect),
+# so a urllib3/botocore upgrade that bypasses the patch fails loudly
+assert AWSHTTPSConnection("s3.amazonaws.com").blocksize == HTTP_BLOCKSIZE, \
+    "HTTP blocksize patch did not reach botocore's HTTPS connections"
+
+@functools.lru_cache(maxsize=1)
 def get_s3_client():
+    # boto3 clients are thread-safe: build one per process and share its connection pool
     return boto3.client(
         's3',
         endpoint_url=S3_ENDPOINT,
         aws_access_key_id=S3_ACCESS_KEY,
         aws_secret_access_key=S3_SECRET_KEY,
-        region_name=S3_REGION
+        region_name=S3_REGION,
+        config=Config(
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            retries={'mode': 'adaptive', 'max_attempts': 5}
+        )
     )
 
-def upload_to_s3(file_path: str, key_name: str, content_type: str):
+def public_url_for(key_name: str) -> str:
+    # Clean URL to avoid double slashes
+    base = PUBLIC_BASE_URL.rstrip("/")
+    key = key_name.lstrip("/")
+    return f"{base}/{key}"
+
+def is_known_key(key_name: str) -> bool:
+    with KNOWN_KEYS_LOCK:
+        return key_name in KNOWN_KEYS
+
+def remember_key(key_name: str):
+    with KNOWN_KEYS_LOCK:
+        KNOWN_KEYS[key_name] = True
+
+def object_exists(key_name: str) -> bool:
+    """Checks the bucket for a key, answering from KNOWN_KEYS when possible.
+
+    Only a successful HEAD counts as present; any error means "upload it".
+    """
+    if is_known_key(key_name):
+        return True
+    try:
+        get_s3_client().head_object(Bucket=S3_BUCKET, Key=key_name)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code not in ("404", "NoSuchKey", "NotFound"):
+            # e.g. 403 for missing keys when the credentials lack s3:ListBucket
+            logger.warning(f"S3 HEAD failed for {key_name} ({code}), uploading anyway")
+        return False
+    remember_key(key_name)
+    return True
+
+def upload_to_s3(source: Union[str, bytes], key_name: str, content_type: str,
+                 skip_existing: bool = False):
+    """Uploads a file path, or an image already held in memory, to the bucket.
+
+    With ``skip_existing`` (content-addressed keys) an object already stored
+    under the same key is reused instead of uploaded again.
+    """
     s3 = get_s3_client()
     try:
-        s3.upload_file(
-            file_path, 
-            S3_BUCKET, 
-            key_name, 
-            ExtraArgs={'ContentType': content_type}
-        )
-        # Clean URL to avoid double slashes
-        base = PUBLIC_BASE_URL.rstrip("/")
-        key = key_name.lstrip("/")
-        return f"{base}/{key}"
+        if skip_existing and object_exists(key_name):
+            logger.info(f"S3 object already exists, skipping upload: {key_name}")
+            return public_url_for(key_name)
+
+        upload_args = {
+            'ExtraArgs': {'ContentType': content_type},
+            'Config': S3_TRANSFER_CONFIG
+        }
+        if isinstance(source, bytes):
+            s3.upload_fileobj(io.BytesIO(source), S3_BUCKET, key_name, **upload_args)
+        else:
+            s3.upload_file(source, S3_BUCKET, key_name, **upload_args)
+        if skip_existing:
+            remember_key(key_name)
+        return public_url_for(key_name)
     except Exception as e:
         logger.error(f"S3 Upload Error: {e}")
         return None
 
-def calculate_sha256(file_path: Path) -> str:
-    """Calculates SHA256 hash of a file efficiently using chunks."""
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+def copy_to_file(src, dst):
+    """Copies a file object to disk, using zero-copy sendfile when both sides have an fd."""
+    # fileno() on a SpooledTemporaryFile still in memory rolls it over to disk first,
+    # an extra full copy; small uploads go through copyfileobj instead
+    if not getattr(src, "_rolled", True):
+        shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+        return
+    try:
+        in_fd, out_fd = src.fileno(), dst.fileno()
+        offset = src.tell()
+        sent = os.sendfile(out_fd, in_fd, offset, COPY_BUFFER_SIZE)
+    except (AttributeError, OSError):
+        # No real fd or sendfile unsupported for this pair
+        shutil.copyfileobj(src, dst, length=COPY_BUFFER_SIZE)
+        return
+    while sent:
+        offset += sent
+        sent = os.sendfile(out_fd, in_fd, offset, COPY_BUFFER_SIZE)
+
+async def download_to_file(url: str, dst, timeout: float = 15):
+    """Streams a remote file into an open binary file without blocking the event loop."""
+    async with http_client.stream("GET", url, timeout=timeout) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_raw(COPY_BUFFER_SIZE):
+            dst.write(chunk)
+
+async def download_bytes(url: str, timeout: float = 15) -> bytes:
+    r = await http_client.get(url, timeout=timeout)
+    r.raise_for_status()
+    return r.content
+
+def evict_overlay_cache():
+    """Drops the least recently used overlays beyond OVERLAY_CACHE_MAX."""
+    entries = []
+    for p in OVERLAY_CACHE_DIR.iterdir():
+        if p.suffix == ".part":
+            continue
+        try:
+            entries.append((p.stat().st_atime, p))
+        except FileNotFoundError:
+            pass  # Another worker evicted it first
+    if len(entries) <= OVERLAY_CACHE_MAX:
+        return
+    entries.sort()
+    for _, stale in entries[:len(entries) - OVERLAY_CACHE_MAX]:
+        stale.unlink(missing_ok=True)
+
+async def get_overlay(url: str) -> Optional[Path]:
+    """Returns a cached copy of the overlay, downloading it on a miss.
+
+    Failures are logged and the image is rendered without the overlay.
+    """
+    digest = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+    cached = OVERLAY_CACHE_DIR / digest
+    try:
+        # mtime is the download time (TTL); hits only refresh atime (LRU)
+        st = cached.stat()
+        if time.time() - st.st_mtime < OVERLAY_CACHE_TTL:
+            os.utime(cached, (time.time(), st.st_mtime))
+            return cached
+    except FileNotFoundError:
+        pass
+
+    part = OVERLAY_CACHE_DIR / f"{digest}.{uuid.uuid4().hex}.part"
+    try:
+        OVERLAY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(part, "wb") as f:
+            await download_to_file(url, f, timeout=10)
+        # Atomic rename: concurrent requests never see a partial overlay
+        os.replace(part, cached)
+    except Exception as e:
+        logger.warning(f"Overlay download failed: {e}")
+        return None
+    finally:
+        part.unlink(missing_ok=True)
+
+    try:
+        evict_overlay_cache()
+    except OSError as e:
+        logger.warning(f"Overlay cache eviction failed: {e}")
+    return cached
+
+async def iter_chunks(src, size: int = COPY_BUFFER_SIZE):
+    """Streams an in-memory file object as async chunks for run_magick's stdin."""
+    while chunk := src.read(size):
+        yield chunk
+
+async def run_magick(cmd: list, output_path: Optional[Path] = None, chunks=None,
+                     stdin=None, **exec_args) -> tuple:
+    """Runs magick without blocking the event loop, hashing stdout as it arrives.
+
+    ``chunks`` feeds stdin from an async byte stream (a download still in
+    progress, or an upload held in memory). Returns (CompletedProcess, digest);
+    with ``output_path`` the render is teed to disk instead of being kept in memory.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if chunks is not None else stdin,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        **exec_args
+    )
+
+    hasher = OUTPUT_DIGEST()
+
+    async def feed():
+        if chunks is None:
+            return
+        try:
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # magick exited early; its stderr says why
+        finally:
+            proc.stdin.close()
+
+    async def drain():
+        with open(output_path, "wb") if output_path else io.BytesIO() as sink:
+            while chunk := await proc.stdout.read(COPY_BUFFER_SIZE):
+                hasher.update(chunk)
+                sink.write(chunk)
+            return None if output_path else sink.getvalue()
+
+    try:
+        stdout, stderr, _ = await asyncio.gather(drain(), proc.stderr.read(), feed())
+    except BaseException:
+        # Source download failed mid-stream (or the request was cancelled):
+        # don't leave a half-fed magick behind
+        if proc.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                proc.kill()  # may have exited but not been reaped yet
+        await proc.wait()
+        raise
+    return subprocess.CompletedProcess(cmd, await proc.wait(), stdout, stderr), hasher.hexdigest()
+
+def scan_source(source) -> tuple:
+    """Reads the image header and returns (needs_auto_orient, needs_srgb)."""
+    try:
+        with Image.open(source) as img:
+            fmt = img.format
+            # JPEG/WEBP keep EXIF in the header, where getexif() reads it without
+            # decoding. PNG's getexif() calls load() when there's no eXIf chunk
+            # before IDAT, so only trust one already parsed. Other formats keep
+            # -auto-orient.
+            if fmt in ("JPEG", "WEBP"):
+                orientation = img.getexif().get(0x0112, 1)
+            elif fmt == "PNG" and "exif" in img.info:
+                orientation = img.getexif().get(0x0112, 1)
+            else:
+                orientation = None
+            icc = img.info.get("icc_profile")
+            mode = img.mode
+        is_srgb = not icc or "sRGB" in ImageCms.getProfileDescription(
+            ImageCms.ImageCmsProfile(io.BytesIO(icc))
+        )
+    except Exception:
+        # Unknown to Pillow (e.g. HEIC) or malformed: keep the full pipeline
+        return True, True
+    return orientation != 1, not (mode in ("RGB", "RGBA") and is_srgb)
+
+@functools.lru_cache(maxsize=128)
+def build_template(format: str, size: Optional[int], square: bool, has_overlay: bool,
+                   strip_exif: bool, overlay_opacity: int, avif_speed: str, q: int,
+                   overlay_scale: int, overlay_safe_zone: bool,
+                   auto_orient: bool = True, to_srgb: bool = True) -> tuple:
+    """Builds the ImageMagick 7 argv with {input}/{overlay} placeholders."""
+    threads = AVIF_THREAD_LIMIT if format in ["avif", "heic"] else MAGICK_THREAD_LIMIT
+    cmd = ["magick", "{input}"]
+    cmd.extend(["-limit", "thread", threads])
+    if auto_orient:
+        cmd.append("-auto-orient")
+    if to_srgb:
+        cmd.extend(["-colorspace", "sRGB"])
+
+    if strip_exif:
+        cmd.append("-strip")
+
+    if size:
+        cmd.extend(["-filter", "Lanczos"])
+        if square:
+            cmd.extend(["-resize", f"{size}x{size}^"])
+            cmd.extend(["-gravity", "center", "-extent", f"{size}x{size}"])
+        else:
+            cmd.extend(["-resize", f"{size}x{size}>"])
+
+    # Overlay Logic
+    if has_overlay:
+        target_width = size if size else 1920
+        logo_width = int(target_width * (overlay_scale / 100))
+        # Protect against division by zero or extremely small logos
+        logo_width = max(logo_width, 10) 
+    
+        gravity = "South" if overlay_safe_zone else "SouthEast"
+        geometry = "+0+250" if overlay_safe_zone else "+50+50"
+
+        cmd.append("(")
+        cmd.append("{overlay}")
+        cmd.extend(["-resize", f"{logo_width}x"])
+        if overlay_opacity < 100:
+            factor = overlay_opacity / 100.0
+            cmd.extend(["-channel", "A", "-evaluate", "multiply", str(factor)])
+        cmd.append(")")
+        cmd.extend(["-gravity", gravity])
+        cmd.extend(["-geometry", geometry])
+        cmd.append("-composite")
+
+    # Subtle sharpening for web display
+    cmd.extend(["-unsharp", "0x0.75+0.75+0.008"])
+
+    # Encoding Parameters
+    cmd.extend(arg.format(q=q, avif_speed=avif_speed) for arg in FORMATS[format].enc)
+
+    # Always render to stdout: the caller hashes it on the way to memory or disk
+    cmd.append(f"{format}:-")
+
+    return tuple(cmd)
+
+def render_with_vips(data: bytes, format: str, q: int, size: int, square: bool,
+                     strip_exif: bool, output_path: Optional[Path] = None) -> bytes:
+    """Resizes, sharpens and encodes in a single demand-driven libvips pipeline."""
+    # thumbnail shrinks on load, auto-rotates and exports sRGB like the magick chain
+    img = pyvips.Image.thumbnail_buffer(
+        data, size,
+        height=size,
+        size="both" if square else "down",  # matches "^" vs ">" resize geometry
+        crop="centre" if square else "none",
+        export_profile="srgb"
+    )
+    img = img.sharpen(sigma=0.75)
+
+    options = {"strip": strip_exif}
+    if format in ["jpg", "jpeg"]:
+        options.update(Q=q, interlace=True)
+    elif format == "webp":
+        options.update(Q=q, effort=6)
+
+    output = img.write_to_buffer(f".{format}", **options)
+    if output_path:
+        output_path.write_bytes(output)
+    return output
 
 def cleanup_temp_dir(path: Path):
     try:
@@ -122,122 +520,147 @@ async def convert(
     if not file and not src_url:
         raise HTTPException(status_code=400, detail="Provide 'file' or 'src_url'")
 
-    if format not in MIME_TYPES:
-         raise HTTPException(status_code=400, detail=f"Format unsupported: {format}")
+    try:
+        spec = FORMATS[format]
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Format unsupported: {format}")
 
     # --- Setup ---
     request_id = str(uuid.uuid4())
-    tmpd = Path(f"/tmp/{request_id}")
-    tmpd.mkdir(parents=True, exist_ok=True)
-    
-    # Register cleanup as a background task for safety
-    background_tasks.add_task(cleanup_temp_dir, tmpd)
+    tmpd = TMP_ROOT / request_id
     
-    input_path = tmpd / "source"
-    overlay_path = tmpd / "overlay_source"
+    source_file = None
     output_filename = f"output.{format}"
     output_path = tmpd / output_filename
 
+    # Start the overlay fetch right away so it overlaps with the source download
+    overlay_task = None
+    if overlay_url:
+        overlay_task = asyncio.create_task(get_overlay(overlay_url))
+
     try:
         # --- 1. Download Source ---
-        if file:
-            with open(input_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-        elif src_url:
-            with requests.get(src_url, stream=True, timeout=15) as r:
-                r.raise_for_status()
-                with open(input_path, "wb") as f:
-                    shutil.copyfileobj(r.raw, f)
+        # Without an overlay the source is piped straight into magick's stdin;
+        # the overlay's ( ... ) group needs the source as a file. That copy is
+        # anonymous (O_TMPFILE where supported) and handed over as /dev/fd/<n>.
+        stream_input = not overlay_url
+        if not stream_input:
+            source_file = tempfile.TemporaryFile(dir=TMP_ROOT)
+            if file:
+                copy_to_file(file.file, source_file)
+            elif src_url:
+                await download_to_file(src_url, source_file)
+            source_file.flush()
 
         # --- 2. Processing Setup ---
-        has_overlay = False
-        if overlay_url:
+        overlay_path = await overlay_task if overlay_task else None
+        has_overlay = overlay_path is not None
+
+        # S3-only requests never need the render on disk: keep it in memory
+        stream_output = upload_s3 and not return_binary
+        render_path = None if stream_output else output_path
+        if render_path:
+            tmpd.mkdir(parents=True, exist_ok=True)
+        output = None
+        rendered = False
+
+        # Fast path: plain resizes of web formats run in-process through libvips
+        if pyvips and VIPS_FAST_PATH and stream_input and size and format in VIPS_FORMATS:
+            source_data = await file.read() if file else await download_bytes(src_url)
             try:
-                with requests.get(overlay_url, stream=True, timeout=10) as r:
-                    r.raise_for_status()
-                    with open(overlay_path, "wb") as f:
-                        shutil.copyfileobj(r.raw, f)
-                has_overlay = True
-            except Exception as e:
-                logger.warning(f"Overlay download failed: {e}")
-
-        # Construct ImageMagick 7 Command
-        cmd = ["magick", str(input_path)]
-        cmd.extend(["-limit", "thread", MAGICK_THREAD_LIMIT])
-        cmd.append("-auto-orient")
-        cmd.extend(["-colorspace", "sRGB"])
-
-        if strip_exif:
-            cmd.append("-strip")
+                async with ENGINE_SLOTS:
+                    output = await asyncio.to_thread(
+                        render_with_vips, source_data, format, q, size, square, strip_exif,
+                        render_path
+                    )
+                out_hash = OUTPUT_DIGEST(output).hexdigest()
+                rendered = True
+            except pyvips.Error as e:
+                logger.warning(f"libvips fast path failed, falling back to ImageMagick: {e}")
+                # Hand the bytes already read to magick instead of fetching them again
+                source_file = tempfile.TemporaryFile(dir=TMP_ROOT)
+                source_file.write(source_data)
+                source_file.flush()
+                stream_input = False
+
+        if not rendered:
+            # Skip orientation/colorspace passes the decoder already satisfies.
+            # Sources still downloading into stdin can't be scanned ahead of time.
+            auto_orient, to_srgb = True, True
+            if SKIP_REDUNDANT_OPS:
+                if not stream_input:
+                    source_file.seek(0)
+                    auto_orient, to_srgb = scan_source(source_file)
+                elif file:
+                    auto_orient, to_srgb = scan_source(file.file)
+
+            # Construct ImageMagick 7 Command from the cached template
+            template = build_template(
+                format, size, square, has_overlay, strip_exif, overlay_opacity,
+                avif_speed, q, overlay_scale, overlay_safe_zone, auto_orient, to_srgb
+            )
+            paths = {
+                "{input}": "-" if stream_input else f"/dev/fd/{source_file.fileno()}",
+                "{overlay}": str(overlay_path),
+            }
+            cmd = [paths.get(arg, arg) for arg in template]
 
-        if size:
-            cmd.extend(["-filter", "Lanczos"])
-            if square:
-                cmd.extend(["-resize", f"{size}x{size}^"])
-                cmd.extend(["-gravity", "center", "-extent", f"{size}x{size}"])
-            else:
-                cmd.extend(["-resize", f"{size}x{size}>"])
-
-        # Overlay Logic
-        if has_overlay:
-            target_width = size if size else 1920
-            logo_width = int(target_width * (overlay_scale / 100))
-            # Protect against division by zero or extremely small logos
-            logo_width = max(logo_width, 10) 
-            
-            gravity = "South" if overlay_safe_zone else "SouthEast"
-            geometry = "+0+250" if overlay_safe_zone else "+50+50"
-
-            cmd.append("(")
-            cmd.append(str(overlay_path))
-            cmd.extend(["-resize", f"{logo_width}x"])
-            if overlay_opacity < 100:
-                factor = overlay_opacity / 100.0
-                cmd.extend(["-channel", "A", "-evaluate", "multiply", str(factor)])
-            cmd.append(")")
-            cmd.extend(["-gravity", gravity])
-            cmd.extend(["-geometry", geometry])
-            cmd.append("-composite")
-
-        # Subtle sharpening for web display
-        cmd.extend(["-unsharp", "0x0.75+0.75+0.008"])
-
-        # Encoding Parameters
-        if format in ["jpg", "jpeg"]:
-            cmd.extend(["-quality", str(q)])
-            cmd.extend(["-interlace", "Plane"])
-        elif format == "avif":
-            # For ImageMagick 7 static binary, heic:speed controls libheif performance
-            cmd.extend(["-quality", str(q)])
-            cmd.extend(["-define", f"heic:speed={avif_speed}"]) 
-        elif format == "webp":
-            cmd.extend(["-quality", str(q)])
-            cmd.extend(["-define", "webp:method=6"])
-
-        cmd.append(str(output_path))
-
-        logger.info(f"Running: {' '.join(cmd)}")
+            logger.info(f"Running: {' '.join(cmd)}")
         
-        # --- EXECUTION ---
-        # Capture stderr to debug ImageMagick specific errors
-        result = subprocess.run(cmd, capture_output=True, text=True)
+            # --- EXECUTION ---
+            # Capture stderr to debug ImageMagick specific errors
+            if stream_input and file:
+                file.file.seek(0)
+                if getattr(file.file, "_rolled", True):
+                    # After scan_source, seek(0) lands inside Python's read buffer
+                    # and never reaches the fd offset magick inherits
+                    os.lseek(file.file.fileno(), 0, os.SEEK_SET)
+                    feed = {"stdin": file.file}
+                else:
+                    # fileno() would roll an in-memory spool to disk: pipe its bytes
+                    feed = {"chunks": iter_chunks(file.file)}
+                async with ENGINE_SLOTS:
+                    result, out_hash = await run_magick(cmd, render_path, **feed)
+            elif stream_input:
+                # Connect and check the status before taking a slot, so slow
+                # origins don't hold up renders that are ready to go
+                async with http_client.stream("GET", src_url) as r:
+                    r.raise_for_status()
+                    async with ENGINE_SLOTS:
+                        result, out_hash = await run_magick(
+                            cmd, render_path, chunks=r.aiter_raw(COPY_BUFFER_SIZE)
+                        )
+            else:
+                async with ENGINE_SLOTS:
+                    result, out_hash = await run_magick(
+                        cmd, render_path, pass_fds=(source_file.fileno(),)
+                    )
         
-        if result.returncode != 0:
-            logger.error(f"ImageMagick Failed: {result.stderr}")
-            raise HTTPException(status_code=500, detail=f"Processing Engine Error: {result.stderr}")
+            if result.returncode != 0:
+                stderr = result.stderr.decode(errors="replace")
+                logger.error(f"ImageMagick Failed: {stderr}")
+                raise HTTPException(status_code=500, detail=f"Processing Engine Error: {stderr}")
+
+            output = result.stdout
 
         # --- 3. Response Construction ---
         response_data = {"ok": True, "format": format}
-        final_content_type = MIME_TYPES[format]
+        final_content_type = spec.mime
 
         if upload_s3:
             # Smart naming generation if key_name is missing
-            if not key_name:
-                in_hash = calculate_sha256(input_path)
-                out_hash = calculate_sha256(output_path)
+            content_addressed = not key_name
+            if content_addressed:
+                # Request parameters identify the rendition without re-reading
+                # the source; the output hash keeps keys content-addressed.
+                source_ref = src_url if src_url else file.filename
+                params = "|".join(str(v) for v in (
+                    format, q, size, square, strip_exif, overlay_url, overlay_scale,
+                    overlay_safe_zone, overlay_opacity, avif_speed, source_ref,
+                ))
+                params_hash = hashlib.blake2b(params.encode(), digest_size=16).hexdigest()
                 size_tag = str(size) if size else "orig"
-                clean_ext = format.replace("jpeg", "jpg") 
-                generated_name = f"{in_hash[:32]}_{size_tag}_{out_hash[:8]}.{clean_ext}"
+                generated_name = f"{params_hash}_{size_tag}_{out_hash}.{spec.ext}"
                 
                 # Folder/Prefix handling
                 if key_prefix:
@@ -246,27 +669,57 @@ async def convert(
                 else:
                     key_name = generated_name
             
-            logger.info(f"Uploading to S3: {key_name} as {final_content_type}")
-            public_url = upload_to_s3(str(output_path), key_name, final_content_type)
-            
-            if public_url:
-                response_data["url"] = public_url
+            if return_binary:
+                logger.info(f"Uploading to S3: {key_name} as {final_content_type}")
+                public_url = upload_to_s3(
+                    str(output_path), key_name, final_content_type, skip_existing=content_addressed
+                )
+                
+                if public_url:
+                    response_data["url"] = public_url
+                    response_data["key"] = key_name
+                else:
+                    response_data["error"] = "Upload failed"
+            elif content_addressed and is_known_key(key_name):
+                # Same render was stored moments ago: nothing to upload
+                response_data["url"] = public_url_for(key_name)
                 response_data["key"] = key_name
+                response_data["status"] = "exists"
             else:
-                response_data["error"] = "Upload failed"
+                # The URL is deterministic, so answer now and upload after the response
+                logger.info(f"Scheduling S3 upload: {key_name} as {final_content_type}")
+                background_tasks.add_task(
+                    upload_to_s3, output, key_name, final_content_type, skip_existing=content_addressed
+                )
+                response_data["url"] = public_url_for(key_name)
+                response_data["key"] = key_name
+                response_data["status"] = "uploading"
+
+        # Background tasks run in order, so cleanup always follows a deferred upload
+        background_tasks.add_task(cleanup_temp_dir, tmpd)
 
         if return_binary:
             clean_name = key_name.split("/")[-1] if key_name else output_filename
+            # A known stat lets Starlette set Content-Length/ETag up front (keep-alive
+            # friendly) and hand the path to servers offering zero-copy pathsend.
             return FileResponse(
                 path=output_path, 
                 media_type=final_content_type,
-                filename=clean_name
+                filename=clean_name,
+                stat_result=os.stat(output_path)
             )
 
         return JSONResponse(content=response_data)
 
     except HTTPException as he:
+        cleanup_temp_dir(tmpd)
         raise he
     except Exception as e:
+        cleanup_temp_dir(tmpd)
         logger.error(f"Process Error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if overlay_task and not overlay_task.done():
+            overlay_task.cancel()
+        if source_file:
+            source_file.close()